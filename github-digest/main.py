@@ -2,20 +2,23 @@ from __future__ import annotations
 
 import argparse
 import datetime
-import html
 import os
 import smtplib
 import ssl
 
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from itertools import groupby
+from operator import attrgetter
 from pathlib import Path
-from typing import Literal, Iterator
+from typing import Any, Iterable, Literal
 from urllib.parse import quote
 
 import msgspec
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 
 ROOT = Path(__file__).absolute().parent.parent
@@ -34,26 +37,65 @@ IGNORE_REPOS = {
     "NixOS/nixpkgs",
 }
 
+# Search qualifiers for excluding ignored repos server-side. Authors are still
+# only filtered client-side, since the ignore list includes bot accounts and
+# commit author names that search qualifiers can't reliably match.
+EXCLUDE_REPOS = " ".join(f"-repo:{repo}" for repo in sorted(IGNORE_REPOS))
 
-class Repo(msgspec.Struct, rename="camel"):
+# Equivalent to `html.escape`, but done in a single pass
+HTML_ESCAPES = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"}
+)
+
+# Display labels for each item type
+LABELS = {"Issue": "Issue", "PullRequest": "PR", "Discussion": "Discussion"}
+
+TEMPLATES = {
+    name: (ROOT / "github-digest" / name).read_text()
+    for name in ["issues.graphql", "discussions.graphql", "commits.graphql"]
+}
+
+# A single session shared by all requests, so connections to the API are
+# pooled and reused. Transient gateway errors are retried with backoff; the
+# GraphQL requests are all read-only queries, so POSTs are safe to retry too.
+SESSION = requests.Session()
+# requests defaults to this already, but be explicit since the responses are
+# verbose JSON and compress well.
+SESSION.headers["Accept-Encoding"] = "gzip, deflate"
+SESSION.mount(
+    "https://api.github.com",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods={"GET", "POST"},
+        ),
+    ),
+)
+
+
+class Repo(msgspec.Struct, rename="camel", gc=False):
     name_with_owner: str
 
 
-class Actor(msgspec.Struct):
+class Actor(msgspec.Struct, gc=False):
     type: str
     login: str
 
 
-class Comment(msgspec.Struct, rename="camel"):
+class Comment(msgspec.Struct, rename="camel", gc=False):
     updated_at: datetime.datetime
 
 
-class Comments(msgspec.Struct, rename="camel", frozen=True):
+class Comments(msgspec.Struct, rename="camel", frozen=True, gc=False):
     items: list[Comment] = []
     total_count: int = 0
 
 
-class Item(msgspec.Struct, rename="camel", kw_only=True):
+class Item(msgspec.Struct, rename="camel", kw_only=True, gc=False):
     type: Literal["Issue", "PullRequest", "Discussion"]
     author: Actor
     url: str
@@ -63,19 +105,18 @@ class Item(msgspec.Struct, rename="camel", kw_only=True):
     repo: Repo
     number: int
     title: str
-    state: Literal["CLOSED", "MERGED", "OPEN", None] = None
     comments: Comments
     reviews: Comments = Comments()
 
 
-class PageInfo(msgspec.Struct, rename="camel"):
+class PageInfo(msgspec.Struct, rename="camel", gc=False):
     has_next_page: bool
     end_cursor: str | None = None
 
 
-class SearchResults(msgspec.Struct):
-    class _Search1(msgspec.Struct):
-        class _Search2(msgspec.Struct, rename="camel"):
+class SearchResults(msgspec.Struct, gc=False):
+    class _Search1(msgspec.Struct, gc=False):
+        class _Search2(msgspec.Struct, rename="camel", gc=False):
             page_info: PageInfo
             items: list[Item]
 
@@ -84,15 +125,15 @@ class SearchResults(msgspec.Struct):
     data: _Search1
 
 
-class Commit(msgspec.Struct):
-    class Repository(msgspec.Struct):
+class Commit(msgspec.Struct, gc=False):
+    class Repository(msgspec.Struct, gc=False):
         full_name: str
 
-    class CommitInfo(msgspec.Struct):
-        class Author(msgspec.Struct):
+    class CommitInfo(msgspec.Struct, gc=False):
+        class Author(msgspec.Struct, gc=False):
             name: str
 
-        class Committer(msgspec.Struct):
+        class Committer(msgspec.Struct, gc=False):
             date: datetime.datetime
 
         author: Author
@@ -110,15 +151,15 @@ class Commit(msgspec.Struct):
     info: CommitInfo = msgspec.field(name="commit")
 
 
-class CommitSearchResults(msgspec.Struct):
+class CommitSearchResults(msgspec.Struct, gc=False):
     total_count: int
     items: list[Commit]
 
 
-class CommitNodesResults(msgspec.Struct, rename="camel"):
-    class Data(msgspec.Struct, rename="camel"):
-        class CommitNode(msgspec.Struct, rename="camel"):
-            class PullRequests(msgspec.Struct, rename="camel"):
+class CommitNodesResults(msgspec.Struct, rename="camel", gc=False):
+    class Data(msgspec.Struct, rename="camel", gc=False):
+        class CommitNode(msgspec.Struct, rename="camel", gc=False):
+            class PullRequests(msgspec.Struct, rename="camel", gc=False):
                 total_count: int
 
             associated_pull_requests: PullRequests
@@ -128,33 +169,84 @@ class CommitNodesResults(msgspec.Struct, rename="camel"):
     data: Data
 
 
+class GraphQLErrors(msgspec.Struct, gc=False):
+    class Error(msgspec.Struct, gc=False):
+        message: str
+
+    errors: list[Error] = []
+
+
+SEARCH_DECODER = msgspec.json.Decoder(SearchResults)
+COMMIT_SEARCH_DECODER = msgspec.json.Decoder(CommitSearchResults)
+COMMIT_NODES_DECODER = msgspec.json.Decoder(CommitNodesResults)
+ERRORS_DECODER = msgspec.json.Decoder(GraphQLErrors)
+ENCODER = msgspec.json.Encoder()
+
+
+def graphql(token: str, query: str, variables: dict[str, Any]) -> bytes:
+    # Stream the response and read the body off the socket in one go, rather
+    # than having requests assemble `resp.content` from chunks.
+    with SESSION.post(  # type: ignore
+        "https://api.github.com/graphql",
+        headers={
+            "Authorization": f"bearer {token}",
+            "Content-Type": "application/json",
+        },
+        data=ENCODER.encode({"query": query, "variables": variables}),
+        stream=True,
+    ) as resp:
+        resp.raise_for_status()
+        body = resp.raw.read(decode_content=True)
+    # GraphQL reports errors in the body of a 200 response. Fail early here
+    # rather than with an obscure validation error in the caller's decoder.
+    if b'"errors"' in body and (errors := ERRORS_DECODER.decode(body).errors):
+        raise RuntimeError(
+            "GraphQL query failed: " + "; ".join(e.message for e in errors)
+        )
+    return body
+
+
+def _fetch_search(token: str, file: str, search: str) -> list[Item]:
+    query = TEMPLATES[file]
+    items = []
+    cursor = None
+    while True:
+        variables = {"query": search, "after": cursor}
+        msg = SEARCH_DECODER.decode(graphql(token, query, variables)).data.search
+        items.extend(msg.items)
+        if msg.page_info.has_next_page:
+            cursor = msg.page_info.end_cursor
+        else:
+            break
+    return items
+
+
+def _is_recent(item: Item, after: datetime.datetime) -> bool:
+    # Ordered roughly by how often each check succeeds
+    if item.created_at >= after:
+        return True
+    comments = item.comments.items
+    if comments and comments[0].updated_at >= after:
+        return True
+    reviews = item.reviews.items
+    if reviews and reviews[0].updated_at >= after:
+        return True
+    if item.last_edited_at is not None and item.last_edited_at >= after:
+        return True
+    return item.closed_at is not None and item.closed_at >= after
+
+
 def fetch_recent_items(token: str, after: datetime.datetime) -> list[Item]:
-    with requests.Session() as session:
-        search = f"msgspec updated:>={after.date()}"
-        items = []
-        # Fetch recent issues, PRs, and discussions
-        for file in ["issues.graphql", "discussions.graphql"]:
-            with open(ROOT / "github-digest" / file, "r") as f:
-                template = f.read()
-            cursor = None
-            while True:
-                params = f'query: "{search}"'
-                if cursor is not None:
-                    params += f', after: "{cursor}"'
-
-                query = template % params
-                resp = session.post(  # type: ignore
-                    "https://api.github.com/graphql",
-                    headers={"Authorization": f"bearer {token}"},
-                    json={"query": query},
-                )
-                resp.raise_for_status()
-                msg = msgspec.json.decode(resp.content, type=SearchResults).data.search
-                items.extend(msg.items)
-                if msg.page_info.has_next_page:
-                    cursor = msg.page_info.end_cursor
-                else:
-                    break
+    search = f"msgspec updated:>={after.isoformat()} {EXCLUDE_REPOS}"
+    # Fetch recent issues, PRs, and discussions. Pages within a search have to
+    # be fetched in order (the cursors chain), but the searches themselves are
+    # independent and can be run concurrently.
+    files = ["issues.graphql", "discussions.graphql"]
+    with ThreadPoolExecutor(len(files)) as executor:
+        futures = [
+            executor.submit(_fetch_search, token, file, search) for file in files
+        ]
+        items = [item for future in futures for item in future.result()]
     return [
         item
         for item in items
@@ -162,13 +254,7 @@ def fetch_recent_items(token: str, after: datetime.datetime) -> list[Item]:
             item.author.login not in IGNORE_AUTHORS
             and item.author.type != "Bot"
             and item.repo.name_with_owner not in IGNORE_REPOS
-            and (
-                item.created_at >= after
-                or (item.last_edited_at is not None and item.last_edited_at >= after)
-                or (item.closed_at is not None and item.closed_at >= after)
-                or (item.comments.items and item.comments.items[0].updated_at >= after)
-                or (item.reviews.items and item.reviews.items[0].updated_at >= after)
-            )
+            and _is_recent(item, after)
         )
     ]
 
@@ -176,43 +262,34 @@ def fetch_recent_items(token: str, after: datetime.datetime) -> list[Item]:
 def fetch_recent_commits(token: str, after: datetime.datetime) -> list[Commit]:
     commits = []
 
-    with requests.Session() as session:
-        # Fetch recent commits. This isn't exposed through graphql currently.
-        query = quote(f"msgspec committer-date:>={after.date()}")
-        resp = session.get(  # type: ignore
-            (
-                f"https://api.github.com/search/commits"
-                f"?q={query}&sort=committer-date&order=desc&per_page=100"
-            ),
-            headers={
-                "Accept": "application/vnd.github+json",
-                "Authorization": f"Bearer {token}",
-                "X-GitHub-Api-Version": "2022-11-28",
-            },
-        )
+    # Fetch recent commits. This isn't exposed through graphql currently.
+    query = quote(f"msgspec committer-date:>={after.isoformat()} {EXCLUDE_REPOS}")
+    with SESSION.get(  # type: ignore
+        (
+            f"https://api.github.com/search/commits"
+            f"?q={query}&sort=committer-date&order=desc&per_page=100"
+        ),
+        headers={
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"Bearer {token}",
+            "X-GitHub-Api-Version": "2022-11-28",
+        },
+        stream=True,
+    ) as resp:
         resp.raise_for_status()
-        commit_search = msgspec.json.decode(resp.content, type=CommitSearchResults)
-
-        if commit_search.items:
-            node_ids = [commit.node_id for commit in commit_search.items]
-
-            # Filter out commits that have an associated PR. This can only be
-            # done by graphql.
-            with open(ROOT / "github-digest" / "commits.graphql", "r") as f:
-                template = f.read()
-            query = template % msgspec.json.encode(node_ids).decode()
-            resp = session.post(  # type: ignore
-                "https://api.github.com/graphql",
-                headers={"Authorization": f"bearer {token}"},
-                json={"query": query},
-            )
-            resp.raise_for_status()
-            nodes = msgspec.json.decode(
-                resp.content, type=CommitNodesResults
-            ).data.nodes
-            for commit, node in zip(commit_search.items, nodes):
-                if node.associated_pull_requests.total_count == 0:
-                    commits.append(commit)
+        body = resp.raw.read(decode_content=True)
+    commit_search = COMMIT_SEARCH_DECODER.decode(body)
+
+    if commit_search.items:
+        node_ids = [commit.node_id for commit in commit_search.items]
+
+        # Filter out commits that have an associated PR. This can only be
+        # done by graphql.
+        body = graphql(token, TEMPLATES["commits.graphql"], {"ids": node_ids})
+        nodes = COMMIT_NODES_DECODER.decode(body).data.nodes
+        for commit, node in zip(commit_search.items, nodes):
+            if node.associated_pull_requests.total_count == 0:
+                commits.append(commit)
 
     return [
         commit
@@ -223,56 +300,69 @@ def fetch_recent_commits(token: str, after: datetime.datetime) -> list[Commit]:
     ]
 
 
-def format_plain(groups: dict[str, list[Item | Commit]]) -> str:
-    def gen() -> Iterator[str]:
-        first = True
-        for repo, items in sorted(groups.items()):
-            if not first:
-                yield ""
-            else:
-                first = False
-            yield f"**{repo}**"
-            for item in items:
-                if isinstance(item, Item):
-                    label = "PR" if item.type == "PullRequest" else item.type
-                    yield f"- {label} #{item.number}: {item.title} <{item.url}>"
-                else:
-                    yield (
-                        f"- Commit {item.sha[:8]}: {item.info.title} <{item.html_url}>"
-                    )
-
-    return "\n".join(gen())
-
-
-def format_html(groups: dict[str, list[Item | Commit]]) -> str:
-    def gen() -> Iterator[str]:
-        first = True
-        yield '<div dir="ltr">'
-        for repo, items in sorted(groups.items()):
-            if not first:
-                yield "<div><br></div>"
-            else:
-                first = False
-            yield f"<div><b>{repo}</b></div>"
-            for item in items:
-                if isinstance(item, Item):
-                    label = "PR" if item.type == "PullRequest" else item.type
-                    title = html.escape(item.title)
-                    count = item.comments.total_count + item.reviews.total_count
-                    suffix = f" <i>({count} comments)</i>" if count else ""
-                    yield (
-                        f'<div>- <a href="{item.url}">{label} #{item.number}</a>'
-                        f": {title}{suffix}</div>"
-                    )
-                else:
-                    title = html.escape(item.info.title)
-                    yield (
-                        f'<div>- <a href="{item.html_url}">Commit {item.sha[:8]}</a>'
-                        f": {title}</div>"
-                    )
-        yield "</div>"
-
-    return "".join(gen())
+def group_by_repo(
+    items: list[Item], commits: list[Commit]
+) -> list[tuple[str, list[Item], list[Commit]]]:
+    item_repo = attrgetter("repo.name_with_owner")
+    commit_repo = attrgetter("repo.full_name")
+    item_groups = {
+        repo: list(group)
+        for repo, group in groupby(sorted(items, key=item_repo), item_repo)
+    }
+    commit_groups = {
+        repo: list(group)
+        for repo, group in groupby(sorted(commits, key=commit_repo), commit_repo)
+    }
+    return [
+        (repo, item_groups.get(repo, []), commit_groups.get(repo, []))
+        for repo in sorted(item_groups.keys() | commit_groups.keys())
+    ]
+
+
+def format_plain(groups: Iterable[tuple[str, list[Item], list[Commit]]]) -> str:
+    parts: list[str] = []
+    for repo, items, commits in groups:
+        if parts:
+            parts.append("")
+        parts.append(f"**{repo}**")
+        for item in items:
+            label = LABELS[item.type]
+            parts.append(f"- {label} #{item.number}: {item.title} <{item.url}>")
+        for commit in commits:
+            parts.append(
+                f"- Commit {commit.sha[:8]}: {commit.info.title} <{commit.html_url}>"
+            )
+    return "\n".join(parts)
+
+
+def format_html(groups: Iterable[tuple[str, list[Item], list[Commit]]]) -> str:
+    parts = ['<div dir="ltr">']
+    append = parts.append
+    escapes = HTML_ESCAPES
+    for repo, items, commits in groups:
+        if len(parts) > 1:
+            append("<div><br></div>")
+        append(f"<div><b>{repo}</b></div>")
+        for item in items:
+            label = LABELS[item.type]
+            title = item.title.translate(escapes)
+            count = item.comments.total_count
+            if item.type == "PullRequest":
+                # Only PRs have reviews
+                count += item.reviews.total_count
+            suffix = f" <i>({count} comments)</i>" if count else ""
+            append(
+                f'<div>- <a href="{item.url}">{label} #{item.number}</a>'
+                f": {title}{suffix}</div>"
+            )
+        for commit in commits:
+            title = commit.info.title.translate(escapes)
+            append(
+                f'<div>- <a href="{commit.html_url}">Commit {commit.sha[:8]}</a>'
+                f": {title}</div>"
+            )
+    append("</div>")
+    return "".join(parts)
 
 
 def send_email(
@@ -308,21 +398,26 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    # Load .env file if present
+    # Load .env file if present. Values are kept local rather than written
+    # back to `os.environ`, and take precedence over the environment.
+    env = dict(os.environ)
     try:
         with open(ROOT / ".env", "r") as f:
-            for line in f.readlines():
-                key, val = line.strip().split("=", 1)
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                key, _, val = line.partition("=")
                 val = val.removeprefix('"').removesuffix('"')
-                os.environ[key] = val
+                env[key] = val
     except FileNotFoundError:
         pass
 
     # Read secrets from environment
-    EMAIL_USERNAME = os.environ["EMAIL_USERNAME"]
-    EMAIL_ADDRESS = os.environ["EMAIL_ADDRESS"]
-    EMAIL_PASSWORD = os.environ["EMAIL_PASSWORD"]
-    GITHUB_TOKEN = os.environ["GITHUB_TOKEN"]
+    EMAIL_USERNAME = env["EMAIL_USERNAME"]
+    EMAIL_ADDRESS = env["EMAIL_ADDRESS"]
+    EMAIL_PASSWORD = env["EMAIL_PASSWORD"]
+    GITHUB_TOKEN = env["GITHUB_TOKEN"]
 
     today = datetime.date.today()
     yesterday = today - datetime.timedelta(days=1)
@@ -331,15 +426,15 @@ def main() -> None:
         yesterday, datetime.time(14, tzinfo=datetime.timezone.utc)
     )
 
-    items = fetch_recent_items(GITHUB_TOKEN, after)
-    commits = fetch_recent_commits(GITHUB_TOKEN, after)
+    # Run the item and commit searches concurrently
+    with ThreadPoolExecutor(2) as executor:
+        items_future = executor.submit(fetch_recent_items, GITHUB_TOKEN, after)
+        commits_future = executor.submit(fetch_recent_commits, GITHUB_TOKEN, after)
+        items = items_future.result()
+        commits = commits_future.result()
 
     if items or commits:
-        groups: defaultdict[str, list[Item | Commit]] = defaultdict(list)
-        for item in items:
-            groups[item.repo.name_with_owner].append(item)
-        for commit in commits:
-            groups[commit.repo.full_name].append(commit)
+        groups = group_by_repo(items, commits)
         plain = format_plain(groups)
         html = format_html(groups)
         subject = f"GitHub Search Digest: msgspec ({today})"